@@ -209,14 +209,35 @@ class NumpyDataset(BaseDataset):
         super().__init__(
             feat_scp, len_scp, min_len, mvn_path, seg_len, seg_shift, rand_seg
         )
+        self._mmaps = {}
         self._mvn_prep(mvn_path)
 
+    def __getstate__(self):
+        # Pickling a memmap would copy the whole file into DataLoader workers
+        state = self.__dict__.copy()
+        state["_mmaps"] = {}
+        return state
+
+    def _load_feat(self, entry: str):
+        """Returns a read-only view of the features of a feats.scp entry.
+
+        Entries are "<feats.bin path> <byte offset> <rows> <columns>".
+
+        """
+        path, offset, rows, cols = entry.rsplit(None, 3)
+        if path not in self._mmaps:
+            self._mmaps[path] = np.memmap(path, dtype=np.float32, mode="r")
+        data = self._mmaps[path]
+        start = int(offset) // data.itemsize
+        rows, cols = int(rows), int(cols)
+        return data[start : start + rows * cols].reshape(rows, cols)
+
     def __getitem__(self, index):
         """Returns key(sequence), feature, and number of segments."""
         seg = self.segs[index]
         idx = self.seq2idx[seg.seq]
-        with open(self.seq_feats[idx], "rb") as f:
-            feat = np.load(f)[seg.start : seg.end]
+        # Copy the segment out of the read-only memory map
+        feat = np.array(self._load_feat(self.seq_feats[idx])[seg.start : seg.end])
         feat = self.apply_mvn(feat)
         nsegs = self.seq_nsegs[idx]
 
@@ -226,7 +247,7 @@ class NumpyDataset(BaseDataset):
         """Compute mean and variance normalization."""
         n, x, x2 = 0.0, 0.0, 0.0
         for seq in self.seqlist:
-            feat = np.load(self.feats[seq])
+            feat = self._load_feat(self.feats[seq])
             x += np.sum(feat, axis=0, keepdims=True)
             x2 += np.sum(feat ** 2, axis=0, keepdims=True)
             n += feat.shape[0]
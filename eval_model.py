@@ -48,7 +48,7 @@ if args.tensorboard:
     tensorboard_logger = TensorBoardLogger(run_id, args.tb_log_dir, args.log_params)
 
 if args.step == -1:
-    checkpoint_file = list(Path(args.exp_dir).glob("best_model*.tar"))[0]
+    checkpoint_file = next(Path(args.exp_dir).glob("best_model*.tar"))
 else:
     checkpoint_file = sorted(Path(args.exp_dir).glob("*_*_e*.tar"))[args.step]
 
@@ -1,14 +1,20 @@
 from utils import AudioUtils
 import argparse
-import librosa
 import numpy as np
 import os
 import time
+import collections
 import contextlib
+import functools
+import math
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
-from typing import Tuple, List
+from typing import Deque, Iterable, Iterator, List, Tuple
 from nptyping import Array
 from pathlib import Path
+import torch
+import torchaudio
 
 
 def generate_feat(
@@ -30,24 +36,246 @@ def generate_feat(
         n_mels:      Number of filter banks if using 'fbank' as the computed feature
 
     """
+    return generate_feats(ftype, [audio_data], sample_rate, win_t, hop_t, n_mels)[0]
+
+
+def generate_feats(
+    ftype: str,
+    audio_data: List[Array[float]],
+    sample_rate: int,
+    win_t: float,
+    hop_t: float,
+    n_mels: int,
+    preemphasis: float = 0.97,
+    fft_workers: int = -1,
+) -> List[Array[float]]:
+    """Generates the features for a batch of audio samples
+
+    The features of the whole batch are written into one preallocated matrix,
+    computed in cache-sized tiles of frames by AudioUtils.frames_to_features.
+
+    Args:
+        ftype:       Type of computed feature
+        audio_data:  List of input audio samples
+        sample_rate: Audio sample rate
+        win_t:       FFT window size in seconds
+        hop_t:       Frame spacing in seconds
+        n_mels:      Number of filter banks if using 'fbank' as the computed feature
+        preemphasis: Pre-emphasize raw signal with y[t] = x[t] - r*x[t-1]
+        fft_workers: Number of threads used by the FFT, -1 uses all cores
+
+    Returns:
+        List of (N, D) feature matrices, one per audio sample
+
+    """
+    n_fft = int(sample_rate * win_t)
+    hop_length = int(sample_rate * hop_t)
+    win = AudioUtils.window("hamming", n_fft, n_fft)
     if ftype == "fbank":
-        feat = np.transpose(
-            AudioUtils.to_melspec(
-                audio_data,
-                sample_rate,
-                int(sample_rate * win_t),
-                hop_t,
-                win_t,
-                n_mels=n_mels,
-            )
+        melfb = AudioUtils.mel_filterbank(sample_rate, n_fft, n_mels)
+        n_feats, log_floor = n_mels, -20
+    else:
+        melfb = None
+        n_feats, log_floor = n_fft // 2 + 1, -50
+
+    frames = []
+    for y in audio_data:
+        if preemphasis > 1e-12:
+            y = AudioUtils.preemphasize(y, preemphasis)
+        frames.append(AudioUtils.frame(y, n_fft, hop_length))
+    counts = [len(y_frames) for y_frames in frames]
+
+    feats = np.empty((sum(counts), n_feats), dtype=np.float32)
+    offset = 0
+    for y_frames in frames:
+        AudioUtils.frames_to_features(
+            y_frames,
+            win,
+            melfb,
+            log_floor,
+            out=feats[offset : offset + len(y_frames)],
+            workers=fft_workers,
         )
+        offset += len(y_frames)
+
+    return np.split(feats, np.cumsum(counts)[:-1])
+
+
+@functools.lru_cache(maxsize=4)
+def _spectrogram_transform(
+    n_fft: int, hop_length: int, device: str
+) -> torchaudio.transforms.Spectrogram:
+    """Magnitude spectrogram transform over pre-centred frames, cached per device"""
+    return torchaudio.transforms.Spectrogram(
+        n_fft=n_fft,
+        hop_length=hop_length,
+        window_fn=torch.hamming_window,
+        power=1.0,
+        center=False,
+    ).to(device)
+
+
+@functools.lru_cache(maxsize=4)
+def _mel_filterbank_tensor(
+    sr: int, n_fft: int, n_mels: int, device: str
+) -> torch.Tensor:
+    """AudioUtils.mel_filterbank as a tensor, cached per device"""
+    return torch.tensor(AudioUtils.mel_filterbank(sr, n_fft, n_mels), device=device)
+
+
+def generate_feats_gpu(
+    ftype: str,
+    audio_data: List[Array[float]],
+    sample_rate: int,
+    win_t: float,
+    hop_t: float,
+    n_mels: int,
+    preemphasis: float = 0.97,
+    device: str = "cuda",
+) -> List[Array[float]]:
+    """Generates the features for a batch of audio samples on a torch device
+
+    Produces the same features as generate_feats. The samples are zero-padded
+    into one (B, T) tensor; each is centred before padding so the padding never
+    reaches its frames, and the filter bank is the one used on the CPU path.
+
+    Args:
+        ftype:       Type of computed feature
+        audio_data:  List of input audio samples
+        sample_rate: Audio sample rate
+        win_t:       FFT window size in seconds
+        hop_t:       Frame spacing in seconds
+        n_mels:      Number of filter banks if using 'fbank' as the computed feature
+        preemphasis: Pre-emphasize raw signal with y[t] = x[t] - r*x[t-1]
+        device:      Torch device to compute the features on
+
+    Returns:
+        List of (N, D) feature matrices, one per audio sample
+
+    """
+    n_fft = int(sample_rate * win_t)
+    hop_length = int(sample_rate * hop_t)
+
+    waveforms, counts = [], []
+    for y in audio_data:
+        if preemphasis > 1e-12:
+            y = AudioUtils.preemphasize(y, preemphasis)
+        # Centred padding, as done by AudioUtils.frame
+        y = np.pad(np.asarray(y, dtype=np.float32), n_fft // 2, mode="reflect")
+        waveforms.append(torch.from_numpy(y))
+        counts.append(1 + (len(y) - n_fft) // hop_length)
+
+    batch = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True).to(device)
+    spec = _spectrogram_transform(n_fft, hop_length, device)(batch)
+
+    if ftype == "fbank":
+        spec = _mel_filterbank_tensor(sample_rate, n_fft, n_mels, device) @ spec
+        log_floor = -20
     else:
-        feat = np.transpose(
-            AudioUtils.rstft(
-                audio_data, sample_rate, int(sample_rate * win_t), hop_t, win_t
+        log_floor = -50
+    # log(max(x, e^floor)) == max(log(x), floor)
+    spec = torch.log(spec.clamp_min(math.exp(log_floor)))
+
+    spec = spec.transpose(1, 2).cpu().numpy()
+    return [feat[:count] for feat, count in zip(spec, counts)]
+
+
+def _prefetch_audio(
+    items: Iterable[Tuple[str, str]],
+    sample_rate: int,
+    depth: int = 8,
+    max_workers: int = 4,
+) -> Iterator[Tuple[str, Array[float], int]]:
+    """Loads audio files in background threads, keeping `depth` loads in flight
+
+    Loading spends most of its time in file I/O and decoding, which release
+    the GIL, so the next files are read while the caller computes features.
+
+    Args:
+        items:       Iterable of (sequence, audio path) pairs
+        sample_rate: Sample rate for resampling if not None
+        depth:       Number of files loaded ahead of the consumer
+        max_workers: Number of loader threads
+
+    Yields:
+        (sequence, waveform, sample rate) in the order of items
+
+    """
+    items = iter(items)
+    queue: Deque = collections.deque()
+    with ThreadPoolExecutor(max_workers) as executor:
+
+        def submit(n):
+            for seq, path in itertools.islice(items, n):
+                future = executor.submit(AudioUtils.load, path, sample_rate)
+                queue.append((seq, future))
+
+        submit(depth)
+        while queue:
+            seq, future = queue.popleft()
+            submit(1)
+            y, _sr = future.result()
+            yield seq, y, _sr
+
+
+def _process_shard(
+    items: List[Tuple[str, str]],
+    ftype: str,
+    sample_rate: int,
+    win_t: float,
+    hop_t: float,
+    n_mels: int,
+    batch_size: int,
+    device: str = None,
+) -> Tuple[int, List[Tuple[str, Array[float]]]]:
+    """Loads and featurizes a shard of audio files
+
+    Args:
+        items:       List of (sequence, audio path) pairs from wav.scp
+        ftype:       Type of computed feature
+        sample_rate: Sample rate for resampling if not None
+        win_t:       FFT window size in seconds
+        hop_t:       Frame spacing in seconds
+        n_mels:      Number of filter banks if using 'fbank' as the computed feature
+        batch_size:  Number of audio files transformed together
+        device:      Torch device to compute the features on, or None to use
+                         generate_feats on the CPU
+
+    Returns:
+        The sample rate of the shard and a list of (sequence, feature) for every
+            item
+
+    """
+    results = []
+    seqs, audio_data = [], []
+
+    def flush():
+        if device is None:
+            # Parallelism comes from the process pool, keep the FFT single-threaded
+            feats = generate_feats(
+                ftype, audio_data, sample_rate, win_t, hop_t, n_mels, fft_workers=1
             )
-        )
-    return feat
+        else:
+            feats = generate_feats_gpu(
+                ftype, audio_data, sample_rate, win_t, hop_t, n_mels, device=device
+            )
+        results.extend(zip(seqs, feats))
+        seqs.clear()
+        audio_data.clear()
+
+    for seq, y, _sr in _prefetch_audio(items, sample_rate):
+        if sample_rate is None:
+            sample_rate = _sr
+        elif sample_rate != _sr:
+            raise ValueError(f"Inconsistent sample rate ({sample_rate} != {_sr}.")
+        seqs.append(seq)
+        audio_data.append(y)
+        if len(seqs) == batch_size:
+            flush()
+    if seqs:
+        flush()
+
+    return sample_rate, results
 
 
 def prepare_numpy(
@@ -60,10 +288,17 @@ def prepare_numpy(
     win_t: float = 0.025,
     hop_t: float = 0.010,
     n_mels: int = 80,
+    batch_size: int = 32,
+    n_jobs: int = None,
+    device: str = "cpu",
 ) -> Tuple[int, Tuple[Path, Path, Path]]:
     """Handles Numpy format feature and script file generation and saving
 
-    If dataset_dir does not exist, an error will be raised.
+    The float32 features of a set are concatenated in a single raw feats.bin
+    file; feats.scp maps each sequence to "<feats.bin path> <byte offset> <rows>
+    <columns>".
+
+    If the wav.scp file of the set does not exist, a FileNotFoundError is raised.
 
     Args:
         dataset:     Name of the dataset for which features are generated
@@ -75,6 +310,11 @@ def prepare_numpy(
         win_t:       FFT window size in seconds
         hop_t:       Frame spacing in seconds
         n_mels:      Number of filter banks if using 'fbank' as the computed feature
+        batch_size:  Number of audio files loaded and transformed together
+        n_jobs:      Number of worker processes, defaults to the number of CPUs;
+                         unused unless device is "cpu"
+        device:      Torch device to compute the features on; "cpu" uses
+                         generate_feats in a process pool
 
     """
 
@@ -83,42 +323,60 @@ def prepare_numpy(
     else:
         set_path = Path(dataset_dir) / set_name
 
-    file_paths = []
-    for name in ("wav.scp", "feats.scp", "len.scp"):
-        file_paths.append(set_path / name)
-
-    if not os.path.exists(file_paths[0]):
-        raise ValueError(f"The wav.scp file at {file_paths[0]} does not exist!")
-
-    os.makedirs(set_path, exist_ok=True)
-
-    wav_path, feat_path, len_path = file_paths
+    wav_path, feat_path, len_path = [
+        set_path / name for name in ("wav.scp", "feats.scp", "len.scp")
+    ]
+    bin_path = os.path.join(set_path, "feats.bin")
 
     start_time = time.time()
     count = 0
 
+    with open(wav_path) as wavfile:
+        items = [line.rstrip().split() for line in wavfile]
+    # Each worker task spans several batches so file loading can run ahead of
+    # the feature computation
+    shard_size = batch_size * 8
+    shards = [items[i : i + shard_size] for i in range(0, len(items), shard_size)]
+    process_shard = functools.partial(
+        _process_shard,
+        ftype=ftype,
+        sample_rate=sample_rate,
+        win_t=win_t,
+        hop_t=hop_t,
+        n_mels=n_mels,
+        batch_size=batch_size,
+    )
+
     # Opening multiple files at once with context manager
     with contextlib.ExitStack() as stack:
-        wavfile = stack.enter_context(open(wav_path))
         featfile, lenfile = [
-            stack.enter_context(open(f, "w")) for f in [feat_path, len_path]
+            stack.enter_context(open(f, "w", buffering=1 << 20))
+            for f in [feat_path, len_path]
         ]
-        for i, line in enumerate(wavfile):
-            seq, path = line.rstrip().split()
-            y, _sr = librosa.load(path, sample_rate, mono=True)
+        binfile = stack.enter_context(open(bin_path, "wb", buffering=1 << 22))
+        if device != "cpu":
+            # CUDA cannot be used from forked workers, so the batches are
+            # transformed on the device from this process instead
+            shard_results = map(functools.partial(process_shard, device=device), shards)
+        else:
+            p = stack.enter_context(Pool(n_jobs or os.cpu_count()))
+            # Shards are equal-sized, so keeping wav.scp order costs little and
+            # keeps the sequence indices derived from feats.scp reproducible
+            shard_results = p.imap(process_shard, shards)
+        for _sr, results in shard_results:
             if sample_rate is None:
                 sample_rate = _sr
             elif sample_rate != _sr:
                 raise ValueError(f"Inconsistent sample rate ({sample_rate} != {_sr}.")
-
-            feat = generate_feat(ftype, y, sample_rate, win_t, hop_t, n_mels)
-            np_path = os.path.join(set_path, f"{seq}.npy")
-            with open(np_path, "wb") as numpyfile:
-                np.save(numpyfile, feat)
-            featfile.write(f"{seq} {np_path}\n")
-            lenfile.write(f"{seq} {len(feat)}\n")
-            count = i + 1
-            if (count) % 1000 == 0:
+            for seq, feat in results:
+                feat = np.ascontiguousarray(feat, dtype=np.float32)
+                offset = binfile.tell()
+                binfile.write(feat.data)
+                rows, cols = feat.shape
+                featfile.write(f"{seq} {bin_path} {offset} {rows} {cols}\n")
+            lenfile.writelines(f"{seq} {len(feat)}\n" for seq, feat in results)
+            count += len(results)
+            if count // 1000 > (count - len(results)) // 1000:
                 print(
                     f"{count} {set_name} files in {time.time() - start_time} seconds."
                 )
@@ -179,6 +437,24 @@ if __name__ == "__main__":
         default=80,
         help="Number of filter banks if choosing fbank",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="Number of audio files transformed together",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cpu",
+        help="Torch device to compute features on, e.g. cuda; cpu uses --n_jobs processes",
+    )
     args = parser.parse_args()
     print(args)
 
@@ -192,17 +468,18 @@ if __name__ == "__main__":
         args.win_t,
         args.hop_t,
         args.n_mels,
+        args.batch_size,
+        args.n_jobs,
+        args.device,
     ]
-    # Parallel run if set_name is unspecified
+    # Run all three sets if set_name is unspecified; files within a set are
+    # already processed in parallel
     if args.set_name is None:
-        starmap_args = []
+        results = []
+        files_start_time = time.time()
         for s in ["train", "dev", "test"]:
             func_args[1] = s
-            starmap_args.append(tuple(func_args))
-
-        files_start_time = time.time()
-        with Pool(3) as p:
-            results = p.starmap(prepare_numpy, starmap_args)
+            results.append(prepare_numpy(*func_args))
 
         print(
             f"Processed {sum(r[0] for r in results)} files in {time.time() - files_start_time} seconds."
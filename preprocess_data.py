@@ -28,6 +28,10 @@ def preprocess_data(args):
 
     starmap_args = []
     if args.data_format == "numpy":
+        # Same device selection as train_model
+        feat_device = (
+            "cuda" if args.device == "gpu" and torch.cuda.is_available() else "cpu"
+        )
         for set_name in data_sets:
             func_args = [
                 args.dataset,
@@ -42,8 +46,11 @@ def preprocess_data(args):
             ]
             starmap_args.append(tuple(func_args))
         files_start_time = time.time()
-        with Pool(3) as p:
-            results: Iterable = p.starmap(prepare_numpy, starmap_args)
+        # prepare_numpy parallelizes over the files of a set itself, and pool
+        # workers cannot start pools of their own
+        results: Iterable = [
+            prepare_numpy(*a, device=feat_device) for a in starmap_args
+        ]
     else:
         for set_name in data_sets:
             func_args = [dataset_directory, set_name, args.fbank_conf, args.kaldi_root]
@@ -125,6 +132,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--win-size", type=float, default=0.025, help="Window size in seconds"
     )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cpu",
+        help="Device to compute numpy features on, gpu uses CUDA if available",
+    )
     args = parser.parse_args()
 
     preprocess_data(args)
@@ -1,14 +1,26 @@
 import os
 import time
 import itertools
+import operator
 import argparse
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from pydub import AudioSegment
 from multiprocessing import Pool
 import math
 
 
+def _scan_audios(dir: str) -> Iterator[Tuple[str, str]]:
+    """Recursively yields (audio_identifier, path_to_file) for .flac files"""
+    with os.scandir(dir) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_audios(entry.path)
+            elif entry.name.lower().endswith(".flac"):
+                yield os.path.splitext(entry.name)[0], entry.path
+
+
 # dump wav scp
 def find_audios(dir: Path) -> List[Tuple[str, str]]:
     """Find .flac files in the given directory
@@ -20,12 +32,22 @@ def find_audios(dir: Path) -> List[Tuple[str, str]]:
         Sorted list of (audio_identifier, path_to_file) for all files found
 
     """
-    uid_path = []
-    for root, _, files in sorted(os.walk(dir)):
-        for file in files:
-            if file.lower().endswith(".flac"):
-                uid_path.append((os.path.splitext(file)[0], os.path.join(root, file)))
-    return sorted(uid_path, key=lambda x: x[0])
+    with os.scandir(dir) as it:
+        entries = list(it)
+    uid_path = [
+        (os.path.splitext(entry.name)[0], entry.path)
+        for entry in entries
+        if not entry.is_dir(follow_symlinks=False)
+        and entry.name.lower().endswith(".flac")
+    ]
+    # Directory listing is latency bound, so scan the speaker directories
+    # concurrently
+    subdirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+    with ThreadPoolExecutor() as executor:
+        for found in executor.map(lambda d: list(_scan_audios(d)), subdirs):
+            uid_path.extend(found)
+    uid_path.sort(key=operator.itemgetter(0))
+    return uid_path
 
 
 def convert_audios(filelist):
@@ -49,28 +71,23 @@ def write_scp(
 ) -> None:
     """Writes uid and audio path to Kaldi .scp file"""
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    uid_path = []
+    for se in subset_list:
+        if os.path.exists(root_dir / f"{se}"):
+            uid_path += find_audios(root_dir / f"{se}")
+    uid_path.sort(key=operator.itemgetter(0))
+
+    if data_format == "kaldi" and uid_path:
+        n = math.ceil(len(uid_path) / 8)
+        uid_path_lists = (uid_path[i : i + n] for i in range(0, len(uid_path), n))
+        print(f"Converting {len(uid_path)} utterances to .wav for Kaldi")
+        with Pool(8) as p:
+            # imap preserves the order of the already sorted chunks
+            results = p.imap(convert_audios, uid_path_lists)
+            uid_path = list(itertools.chain.from_iterable(results))
+
     with open(out_path, "w") as f:
-        uid_path = []
-        for se in subset_list:
-            if os.path.exists(root_dir / f"{se}"):
-                uid_path += find_audios(root_dir / f"{se}")
-                if data_format == "kaldi":
-                    n = math.ceil(len(uid_path) / 8)
-                    uid_path_lists = (
-                        uid_path[i : i + n] for i in range(0, len(uid_path), n)
-                    )
-                    print(f"Converting {len(uid_path)} utterances to .wav for Kaldi")
-                    with Pool(8) as p:
-                        results = p.imap(convert_audios, uid_path_lists)
-                        uid_path = sorted(
-                            list(itertools.chain.from_iterable(results)),
-                            key=lambda x: x[0],
-                        )
-                    for uid, path in uid_path:
-                        f.write(f"{uid} {path.replace('.flac','.wav')}\n")
-                else:
-                    for uid, path in uid_path:
-                        f.write(f"{uid} {path}\n")
+        f.writelines(f"{uid} {path}\n" for uid, path in uid_path)
 
 
 def process_librispeech(
@@ -14,7 +14,8 @@ import numpy as np
 from datasets import NumpyDataset, KaldiDataset
 from utils import (
     load_checkpoint_file,
-    save_checkpoint,
+    save_checkpoint_full,
+    save_checkpoint_weights,
     create_training_strings,
     check_best,
     save_args,
@@ -167,7 +168,10 @@ parser.add_argument(
     help="List of hidden units per layer for the pre-stochastic layer decoder",
 )
 parser.add_argument(
-    "--device", type=str, default="gpu", help="Device to use for computations"
+    "--device",
+    type=str,
+    default="gpu",
+    help="Device to use for computations, including numpy feature extraction",
 )
 parser.add_argument(
     "--tensorboard",
@@ -194,6 +198,12 @@ parser.add_argument(
     type=str,
     help="Checkpoint model for continuing training",
 )
+parser.add_argument(
+    "--full-checkpoint-interval",
+    type=int,
+    default=5,
+    help="Save optimizer state and logged values every this many epochs and at the end of training; other epochs only save the model weights",
+)
 parser.add_argument(
     "--finetune",
     dest="finetune",
@@ -310,16 +320,24 @@ if args.continue_from:
         best_val_lb,
         summary_list,
     ) = load_checkpoint_file(args.continue_from, args.finetune)
+    if not args.finetune and optim_state is None:
+        raise ValueError(
+            f"{args.continue_from} is a weights-only checkpoint without optimizer "
+            "state. Resume from a full checkpoint, or pass --finetune to start "
+            "from its weights"
+        )
     args = load_args(os.path.dirname(args.continue_from))
     base_string, exp_string, run_id = create_training_strings(args)
 
     # Load previous values into loggers
     if args.visdom:
         visdom_logger = VisdomLogger(run_id, args.epochs)
-        visdom_logger.load_previous_values(start_epoch, values)
+        if values is not None:
+            visdom_logger.load_previous_values(start_epoch, values)
     if args.tensorboard:
         tensorboard_logger = TensorBoardLogger(run_id, args.tb_log_dir, args.log_params)
-        tensorboard_logger.load_previous_values(start_epoch, values)
+        if values is not None:
+            tensorboard_logger.load_previous_values(start_epoch, values)
 else:
     # Starting fresh
     if not args.is_preprocessed:
@@ -516,24 +534,36 @@ for epoch in range(start_epoch, args.epochs):
     if check_best(val_lower_bound, best_val_lb):
         best_epoch = epoch
 
-    save_checkpoint(
-        model,
-        optimizer,
-        summary_list,
-        values,
-        base_string,
-        epoch,
-        best_epoch,
-        val_lower_bound,
-        best_val_lb,
-        exp_dir,
-    )
+    terminate = check_terminate(epoch, best_epoch, args.patience, args.epochs)
+    # Training can only be resumed from full checkpoints, so the last one
+    # written is always full
+    if (
+        terminate
+        or epoch == args.epochs - 1
+        or (epoch + 1) % args.full_checkpoint_interval == 0
+    ):
+        save_checkpoint_full(
+            model,
+            optimizer,
+            summary_list,
+            values,
+            base_string,
+            epoch,
+            best_epoch,
+            val_lower_bound,
+            best_val_lb,
+            exp_dir,
+        )
+    else:
+        save_checkpoint_weights(
+            model, base_string, epoch, best_epoch, best_val_lb, exp_dir
+        )
 
     print(
         f"====> Epoch: {epoch} Average loss: {train_loss / len(train_loader.dataset):.4f}"
     )
 
-    if check_terminate(epoch, best_epoch, args.patience, args.epochs):
+    if terminate:
         print("Training terminated!")
         break
     summary_list = None
@@ -1,14 +1,47 @@
+import contextlib
+import functools
 import librosa
-from collections import defaultdict
+import numba
+import scipy.fft
+import scipy.signal
+import soundfile
+import soxr
 import numpy as np
 from nptyping import Array
 from pathlib import Path
 import torch
 from simple_fhvae import SimpleFHVAE
 from fhvae import FHVAE
+import os
 import shutil
-from typing import Optional
+from typing import Optional, Tuple
 import pickle
+import zipfile
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+if pyfftw is not None:
+    # Every STFT repeats the same transform sizes, so reuse FFTW plans across
+    # calls. Plans use pyFFTW's default FFTW_ESTIMATE effort, as measuring
+    # costs more than it saves on the short transforms done here.
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(300)
+
+
+def _fft_backend():
+    """Routes scipy.fft calls made in the context to pyFFTW if it is installed"""
+    if pyfftw is None:
+        return contextlib.nullcontext()
+    return scipy.fft.set_backend(pyfftw.interfaces.scipy_fft)
+
+
+# Feature extraction works on tiles of frames whose spectrum fills about half of
+# this much cache, so each tile stays resident through the whole pipeline
+_L2_CACHE_BYTES = 1 << 20
 
 
 def check_best(val_lower_bound, best_val_lb) -> bool:
@@ -45,22 +78,33 @@ def create_output_dir_name(dataset: str, data_format: str, feat_type: str) -> Pa
 def estimate_mu2_dict(model, loader, num_seqs):
     """Estimate mu2 for sequences"""
     model.eval()
-    nseg_table = defaultdict(float)
-    z2_sum_table = defaultdict(float)
-    for _, (idxs, features, nsegs) in enumerate(loader):
-        model(features, idxs, len(loader.dataset), nsegs)
-        z2 = model.qz2_x[0]
-        for _y, _z2 in zip(idxs, z2):
-            z2_sum_table[_y] += _z2
-            nseg_table[_y] += 1
-    mu2_dict = dict()
-    for _y in nseg_table:
-        r = np.exp(model.pz2[1]) / np.exp(model.pmu2[1])
-        mu2_dict[_y] = z2_sum_table[_y] / (nseg_table[_y] + r)
-    return mu2_dict
+    z2_sum = None
+    nseg = None
+    with torch.no_grad():
+        for idxs, features, nsegs in loader:
+            model(features, idxs, len(loader.dataset), nsegs)
+            z2 = model.qz2_x[0]
+            if z2_sum is None:
+                z2_sum = z2.new_zeros(num_seqs, z2.shape[1])
+                nseg = z2.new_zeros(num_seqs)
+            # Sequence indices are already contiguous in [0, num_seqs)
+            idxs = torch.as_tensor(idxs, device=z2.device).long()
+            z2_sum.index_add_(0, idxs, z2)
+            nseg.index_add_(0, idxs, torch.ones_like(idxs, dtype=z2.dtype))
+    if z2_sum is None:
+        return dict()
+    r = np.exp(model.pz2[1]) / np.exp(model.pmu2[1])
+    mu2 = z2_sum / (nseg.unsqueeze(1) + r)
+    return {idx: mu2[idx] for idx in torch.nonzero(nseg).flatten().tolist()}
 
 
 def load_checkpoint_file(checkpoint_file, finetune):
+    """Loads a model, and the training state unless fine-tuning, from a checkpoint
+
+    Tensors are memory-mapped when the checkpoint format allows it, so entries
+    that are not used are never read.
+
+    """
     optim_state = None
     start_epoch = None
     best_val_lb = None
@@ -68,29 +112,45 @@ def load_checkpoint_file(checkpoint_file, finetune):
     values = None
 
     strict_mode = True
-    checkpoint = torch.load(checkpoint_file)
+    # Checkpoints pickle the training state (e.g. summary values), so they
+    # cannot go through the weights-only unpickler. Only the zip-based format
+    # can be memory-mapped; older torch versions wrote the legacy one.
+    checkpoint = torch.load(
+        checkpoint_file,
+        map_location="cpu",
+        mmap=zipfile.is_zipfile(checkpoint_file),
+        weights_only=False,
+    )
     model_type = checkpoint["model_type"]
     model_params = checkpoint["model_params"]
+    assign = True
+    # Parameters are built on the meta device and then replaced by the loaded
+    # tensors, which skips allocating and initialising weights that would
+    # immediately be overwritten
     if model_type == "fhvae":
-        model = FHVAE(*model_params)
+        with torch.device("meta"):
+            model = FHVAE(*model_params)
     elif model_type == "simple_fhvae":
-        model = SimpleFHVAE(*model_params)
+        with torch.device("meta"):
+            model = SimpleFHVAE(*model_params)
     else:
         # Fallback just in case
         print(f"NON-STANDARD MODEL TYPE {model_type} DETECTED")
         model = model_type
         strict_mode = False
-    model.load_state_dict(checkpoint["state_dict"], strict=strict_mode)
+        assign = False
+    model.load_state_dict(checkpoint["state_dict"], strict=strict_mode, assign=assign)
 
     # We don't want to restart training if this is the case
     if not finetune:
-        optim_state = checkpoint["optimizer"]
+        # Weights-only checkpoints have no optimizer state or logged values
+        optim_state = checkpoint.get("optimizer")
         # Checkpoint was saved at the end of an epoch, start from next epoch
         start_epoch = checkpoint["epoch"] + 1
         best_val_lb = checkpoint["best_val_lb"]
-        summary_list = checkpoint["summary_vals"]
+        summary_list = checkpoint.get("summary_vals")
         start_epoch += 1
-        values = checkpoint["values"]
+        values = checkpoint.get("values")
 
     return (
         model,
@@ -113,7 +173,35 @@ def load_args(exp_dir):
     return args
 
 
-def save_checkpoint(
+def _model_params(model) -> tuple:
+    """Model constructor arguments stored with a checkpoint"""
+    return (
+        model.z1_hus,
+        model.z2_hus,
+        model.z1_dim,
+        model.z2_dim,
+        model.x_hus,
+    )
+
+
+def _save_atomic(checkpoint: dict, f_path: Path) -> None:
+    """Writes to a temporary file first so a crash never leaves a partial checkpoint"""
+    tmp_path = f_path.with_name(f"{f_path.name}.tmp")
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, f_path)
+
+
+def _write_checkpoint(
+    checkpoint: dict, model, run_info: str, epoch: int, best_epoch: int, checkpoint_dir
+) -> None:
+    f_str = f"{model.model}_{run_info}_e{epoch}"
+    f_path = Path(checkpoint_dir) / f"{f_str}.tar"
+    _save_atomic(checkpoint, f_path)
+    if best_epoch == epoch:
+        shutil.copyfile(f_path, Path(checkpoint_dir) / f"best_model_{f_str}.tar")
+
+
+def save_checkpoint_full(
     model,
     optimizer,
     summary_list,
@@ -125,34 +213,105 @@ def save_checkpoint(
     best_val_lb: float,
     checkpoint_dir: str,
 ) -> None:
-    """Saves checkpoint files"""
+    """Saves checkpoint files with the full training state"""
 
     checkpoint = {
         "best_val_lb": best_val_lb,
         "best_epoch": best_epoch,
         "epoch": epoch,
         "model_type": model.model,
-        "model_params": (
-            model.z1_hus,
-            model.z2_hus,
-            model.z1_dim,
-            model.z2_dim,
-            model.x_hus,
-        ),
+        "model_params": _model_params(model),
         "optimizer": optimizer.state_dict(),
         "state_dict": model.state_dict(),
         "summary_vals": summary_list,
         "values": values_dict,
     }
+    _write_checkpoint(checkpoint, model, run_info, epoch, best_epoch, checkpoint_dir)
 
-    f_str = f"{model.model}_{run_info}_e{epoch}"
-    f_path = Path(checkpoint_dir) / f"{f_str}.tar"
-    torch.save(checkpoint, f_path)
-    if best_epoch == epoch:
-        shutil.copyfile(f_path, Path(checkpoint_dir) / f"best_model_{f_str}.tar")
+
+def save_checkpoint_weights(
+    model,
+    run_info: str,
+    epoch: int,
+    best_epoch: int,
+    best_val_lb: float,
+    checkpoint_dir: str,
+) -> None:
+    """Saves checkpoint files with the model weights only
+
+    Skips the optimizer state, which is twice the model size for Adam, and the
+    logged values. The checkpoint only holds tensors and plain Python values, so
+    it can be loaded with torch.load(..., weights_only=True).
+
+    """
+
+    checkpoint = {
+        "best_val_lb": float(best_val_lb),
+        "best_epoch": best_epoch,
+        "epoch": epoch,
+        "model_type": model.model,
+        "model_params": _model_params(model),
+        "state_dict": model.state_dict(),
+    }
+    _write_checkpoint(checkpoint, model, run_info, epoch, best_epoch, checkpoint_dir)
+
+
+def _log_magnitude(spec, log_floor, out):
+    """out = max(log(abs(spec)), log_floor) in a single pass over flat arrays"""
+    floor_sq = np.exp(2.0 * log_floor)
+    for i in numba.prange(spec.size):
+        p = spec[i].real * spec[i].real + spec[i].imag * spec[i].imag
+        out[i] = 0.5 * np.log(p) if p > floor_sq else log_floor
+
+
+# Whole arrays are split across threads. Cache-sized tiles are too small to be
+# worth a parallel launch and are often processed in pool workers already, so
+# they use a serial build of the same kernel (prange runs as range).
+_log_magnitude_kernel = numba.njit(parallel=True, fastmath=True)(_log_magnitude)
+_log_magnitude_tile = numba.njit(fastmath=True)(_log_magnitude)
+
+
+@numba.njit(fastmath=True)
+def _log_floor_tile(x, log_floor, out):
+    """out = max(log(x), log_floor) in a single pass over flat arrays"""
+    floor = np.exp(log_floor)
+    for i in range(x.size):
+        out[i] = np.log(x[i]) if x[i] > floor else log_floor
+
+
+@numba.njit(parallel=True, fastmath=True)
+def _frame_rms_kernel(y, win_length, hop_length, out):
+    """out[i] = RMS of y[i * hop_length : i * hop_length + win_length]"""
+    for i in numba.prange(out.size):
+        base = i * hop_length
+        s = 0.0
+        for j in range(win_length):
+            v = y[base + j]
+            s += v * v
+        out[i] = np.sqrt(s / win_length)
 
 
 class AudioUtils:
+    @staticmethod
+    def load(path: str, sr: Optional[int] = None) -> Tuple[Array[float], int]:
+        """Reads an audio file as a mono float32 waveform
+
+        Args:
+            path: Path to the audio file
+            sr:   Sample rate to resample to if not None
+
+        Returns:
+            Waveform of shape (T,) and its sample rate
+
+        """
+        y, _sr = soundfile.read(path, dtype="float32")
+        if y.ndim == 2:
+            y = y.mean(axis=1)
+        if sr is not None and sr != _sr:
+            y = soxr.resample(y, _sr, sr)
+            _sr = sr
+        return y, _sr
+
     @staticmethod
     def stft(
         y: Array[float],
@@ -175,16 +334,130 @@ class AudioUtils:
             preemphasis: Pre-emphasize raw signal with y[t] = x[t] - r*x[t-1]
 
         Returns:
-            (n_fft / 2 + 1, N) matrix; N is number of frames
+            (n_fft / 2 + 1, N) complex64 matrix; N is number of frames
 
         """
+        y = np.asarray(y, dtype=np.float32)
         if preemphasis > 1e-12:
-            y = y - preemphasis * np.concatenate([[0], y[:-1]], 0)
+            y = AudioUtils.preemphasize(y, preemphasis)
         hop_length = int(sr * hop_t)
-        win_length = int(sr * win_t)
-        return librosa.core.stft(
-            y, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window=window
-        )
+        win = AudioUtils.window(window, int(sr * win_t), n_fft)
+        frames = AudioUtils.frame(y, n_fft, hop_length)
+        with _fft_backend():
+            return scipy.fft.rfft(frames * win, n=n_fft, axis=-1, workers=-1).T
+
+    @staticmethod
+    def window(window: str, win_length: int, n_fft: int) -> Array[float]:
+        """Analysis window centred within an FFT frame, as done by librosa
+
+        Args:
+            window:     Type of window
+            win_length: Window size in samples
+            n_fft:      Length of the FFT window
+
+        Returns:
+            float32 vector of shape (n_fft,)
+
+        """
+        win = scipy.signal.get_window(window, win_length).astype(np.float32)
+        lpad = (n_fft - win_length) // 2
+        return np.pad(win, (lpad, n_fft - win_length - lpad))
+
+    @staticmethod
+    def preemphasize(y: Array[float], preemphasis: float = 0.97) -> Array[float]:
+        """Pre-emphasize raw signal with y[t] = x[t] - r*x[t-1]
+
+        Args:
+            y:           Raw waveform of shape (T,)
+            preemphasis: Pre-emphasis coefficient r
+
+        Returns:
+            float32 waveform of shape (T,)
+
+        """
+        y = np.asarray(y, dtype=np.float32)
+        out = np.empty_like(y)
+        out[:1] = y[:1]
+        np.multiply(y[:-1], -preemphasis, out=out[1:])
+        out[1:] += y[1:]
+        return out
+
+    @staticmethod
+    def frame(y: Array[float], n_fft: int, hop_length: int) -> Array[float]:
+        """Slices a waveform into overlapping frames
+
+        The signal is reflect-padded by n_fft // 2 on both sides so that frame t is
+        centred at y[t * hop_length], matching librosa.core.stft.
+
+        Args:
+            y:          Raw waveform of shape (T,)
+            n_fft:      Length of each frame
+            hop_length: Number of samples between consecutive frames
+
+        Returns:
+            (N, n_fft) read-only view; N is number of frames
+
+        """
+        y = np.pad(y, n_fft // 2, mode="reflect")
+        return np.lib.stride_tricks.sliding_window_view(y, n_fft)[::hop_length]
+
+    @staticmethod
+    def frames_to_features(
+        frames: Array[float],
+        win: Array[float],
+        melfb: Optional[Array[float]] = None,
+        log_floor: Optional[float] = None,
+        out: Optional[Array[float]] = None,
+        workers: int = -1,
+    ) -> Array[float]:
+        """Computes (log) magnitude or mel features of frames, tile by tile
+
+        Each tile of frames goes through window, FFT, magnitude, filter bank and
+        log before the next one starts, so its intermediates stay in cache.
+
+        Args:
+            frames:    (N, n_fft) frames, e.g. from AudioUtils.frame
+            win:       Analysis window of shape (n_fft,)
+            melfb:     (n_mels, n_fft / 2 + 1) filter bank applied if not None
+            log_floor: Floor value for log scaling, no log is taken if None
+            out:       C-contiguous float32 array to write the features to
+            workers:   Number of threads used by the FFT, -1 uses all cores
+
+        Returns:
+            (N, D) float32 matrix; D is n_mels or n_fft / 2 + 1
+
+        """
+        n_frames, n_fft = frames.shape
+        n_bins = n_fft // 2 + 1
+        if out is None:
+            n_feats = n_bins if melfb is None else melfb.shape[0]
+            out = np.empty((n_frames, n_feats), dtype=np.float32)
+        # complex64 spectrum of a tile fills half of the cache
+        tile = max(1, _L2_CACHE_BYTES // 2 // (n_bins * 8))
+        for start in range(0, n_frames, tile):
+            out_tile = out[start : start + tile]
+            with _fft_backend():
+                spec = scipy.fft.rfft(
+                    frames[start : start + tile] * win,
+                    n=n_fft,
+                    axis=-1,
+                    workers=workers,
+                )
+            if melfb is None and log_floor is not None:
+                _log_magnitude_tile(
+                    spec.reshape(-1), float(log_floor), out_tile.reshape(-1)
+                )
+                continue
+            spec = np.abs(spec)
+            if melfb is not None:
+                spec = spec @ melfb.T
+            if log_floor is None:
+                out_tile[...] = spec
+            else:
+                _log_floor_tile(
+                    spec.reshape(-1), float(log_floor), out_tile.reshape(-1)
+                )
+        return out
 
     @staticmethod
     def rstft(
@@ -216,11 +489,27 @@ class AudioUtils:
 
         """
         spec = AudioUtils.stft(y, sr, n_fft, hop_t, win_t, window, preemphasis)
-        spec = np.abs(spec)
         if log:
-            spec = np.log(spec)
-            spec[spec < log_floor] = log_floor
-        return spec
+            return AudioUtils.log_magnitude(spec, log_floor)
+        return np.abs(spec).astype(np.float32, copy=False)
+
+    @staticmethod
+    def log_magnitude(spec: Array[complex], log_floor: float) -> Array[float]:
+        """Computes max(log(abs(spec)), log_floor) without intermediate arrays
+
+        Args:
+            spec:      Complex spectrum
+            log_floor: Floor value for log scaling of magnitude
+
+        Returns:
+            Real array with the same shape as spec
+
+        """
+        out = np.empty_like(spec, dtype=spec.real.dtype)
+        _log_magnitude_kernel(
+            spec.ravel(order="K"), float(log_floor), out.ravel(order="K")
+        )
+        return out
 
     @staticmethod
     def to_melspec(
@@ -241,6 +530,7 @@ class AudioUtils:
         Args:
             y:           Numpy array of audio sample
             sr:          Sample rate
+            n_fft:       Length of the FFT window
             hop_t:       Spacing (in seconds) between consecutive frames
             win_t:       Window size (in seconds)
             window:      Type of window applied for STFT
@@ -249,27 +539,48 @@ class AudioUtils:
             log:         If True, use log magnitude
             norm_mel:    Normalize each filter bank to have area of 1 if True;
                              otherwise the peak value of each filter bank is 1
+            log_floor:   Floor value for log scaling of the coefficients
 
         Returns:
             (n_mels, N) matrix; N is number of frames
 
         """
-        spec = AudioUtils.rstft(
-            y, sr, n_fft, hop_t, win_t, window, preemphasis, log=False
+        y = np.asarray(y, dtype=np.float32)
+        if preemphasis > 1e-12:
+            y = AudioUtils.preemphasize(y, preemphasis)
+        frames = AudioUtils.frame(y, n_fft, int(sr * hop_t))
+        # Computed in cache-sized tiles of frames, see frames_to_features
+        melspec = AudioUtils.frames_to_features(
+            frames,
+            AudioUtils.window(window, int(sr * win_t), n_fft),
+            AudioUtils.mel_filterbank(sr, n_fft, n_mels, norm_mel),
+            log_floor if log else None,
         )
-        hop_length = int(sr * hop_t)
-        melspec = librosa.feature.melspectrogram(
-            sr=sr,
-            S=spec,
-            n_fft=n_fft,
-            hop_length=hop_length,
-            n_mels=n_mels,
-            norm=norm_mel,
+        return melspec.T
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def mel_filterbank(
+        sr: int, n_fft: int, n_mels: int = 80, norm_mel: str = "slaney"
+    ) -> Array[float]:
+        """Mel filter bank matrix, cached across calls with the same arguments
+
+        Args:
+            sr:       Sample rate
+            n_fft:    Length of the FFT window
+            n_mels:   Number of filter banks, which are equally spaced in Mel-scale
+            norm_mel: Normalization applied to each filter bank
+
+        Returns:
+            Read-only (n_mels, n_fft / 2 + 1) float32 matrix
+
+        """
+        melfb = librosa.filters.mel(
+            sr=sr, n_fft=n_fft, n_mels=n_mels, norm=norm_mel, dtype=np.float32
         )
-        if log:
-            melspec = np.log(melspec)
-            melspec[melspec < log_floor] = log_floor
-        return melspec
+        # The same array is shared by every caller
+        melfb.setflags(write=False)
+        return melfb
 
     @staticmethod
     def energy_vad(
@@ -289,12 +600,15 @@ class AudioUtils:
             th_ratio: Energy threshold ratio for detection
 
         Returns:
-            Boolean vector indicating whether voice was detected
+            (N,) vector indicating whether voice was detected; N is number of frames
 
         """
         hop_length = int(sr * hop_t)
         win_length = int(sr * win_t)
-        e = librosa.feature.rmse(y, frame_length=win_length, hop_length=hop_length)
+        # Centred frames, as done by librosa.feature.rms
+        y = np.pad(np.asarray(y, dtype=np.float32), win_length // 2, mode="reflect")
+        e = np.empty(1 + (len(y) - win_length) // hop_length)
+        _frame_rms_kernel(y, win_length, hop_length, e)
         th = th_ratio * np.mean(e)
         vad = np.asarray(e > th, dtype=int)
         return vad